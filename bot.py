@@ -5,17 +5,27 @@ import requests
 import praw
 import csv
 import random
-import re
 import time
-import schedule
 from datetime import datetime, date
 import os, sys
 from hf_utils import generate_text, query
+from log_utils import get_logger, log_payload, setup_logging, stop_logging
+from reddit_utils import AckBuffer, StreamCheckpoint, ThingStore, checkpointed_stream
+from post_scheduler import PostScheduler
+from profiler import SamplingProfiler, tag_stage
+from filter_chain import FilterChain, COST_LOCAL, COST_REGEX, COST_INDEX, COST_NETWORK, COST_PAID
 from tagging_mixin import TaggingMixin
+from write_queue import WriteQueue
+from moderation import ModerationEngine, load_local_model
+from topic_matcher import TopicMatcher, load_embedder
+from sample_controller import SampleController
+from text_utils import TextPool, words_below, clean_text, clean_title, get_keywords, find_bad_keywords
 import yaml
 import threading
-from nltk import word_tokenize
-from rake_nltk import Rake
+import functools
+from collections import Counter
+import signal
+import atexit
 from googleapiclient import discovery
 import http.client, urllib.request, urllib.parse, urllib.error, base64
 import json
@@ -40,62 +50,24 @@ _default_negative_keywords = [
 
 _negative_keywords = ["".join(s) for s in _default_negative_keywords]
 
+log = get_logger('bot')
+
 ## Load config details from YAML
 def load_yaml(filename):
     with open(filename, 'r') as stream:
         try:
             return yaml.safe_load(stream)
         except yaml.YAMLError as error:
-            print(error)
-    return None
-
-def words_below(string,max_words):
-    # check to see if an input string would exceed token budget
-    token_list = word_tokenize(string)
-    if len(token_list)>max_words:
-        return False
-    else:
-        return True
-
-def clean_text(generated_text):
-    # look for double-quotes
-    truncate = generated_text.find('"')
-    if truncate>-1:
-        cleanStr = generated_text[:truncate]
-        return cleanStr
-    # if we can't find double-quotes, look for the last newline
-    truncate = generated_text.rfind('\n')
-    if truncate>-1:
-        cleanStr = generated_text[:truncate]
-        return cleanStr
-    # if we can't find a newline, look for the last terminal punctuation or start of new post
-    if re.search(r'[?.!(Reply|Post)]', generated_text):
-        trimPart = re.split(r'[?.!(Reply|Post)]', generated_text)[-1]
-        cleanStr = generated_text.replace(trimPart,'')
-        return cleanStr
-    # if we can't find a newline, use the last space
-    truncate = generated_text.rfind(' ')
-    if truncate>-1:
-        cleanStr = generated_text[:truncate]
-        # using the last space may result in a trailing comma or colon; remove it
-        if cleanStr[-1] in ',;:':
-            cleanStr = cleanStr[:-1]
-        return cleanStr
-    # if we can't even find any spaces, give up
+            log.error(error)
     return None
 
-def get_keywords(text):
-    rake_nltk_var = Rake()
-    rake_nltk_var.extract_keywords_from_text(text)
-    keyword_extracted = rake_nltk_var.get_ranked_phrases()[:10]
-    return keyword_extracted
-
 class reddit_bot:
     def __init__(self, config_file):
         self.config = load_yaml(config_file)
         if not self.config:
-            print('Cannot load config file; check path and formatting')
+            log.error('Cannot load config file; check path and formatting')
             sys.exit()
+        setup_logging(self.config)
         self.bot_backstory = self.config['bot_backstory']
         if self.config['topic_list']:
             self.topic_list = self.config['topic_list']
@@ -115,14 +87,25 @@ class reddit_bot:
         )
         self.me = self.reddit.user.me()
         self.reddit.validate_on_submit = True
-        self.sub = self.reddit.subreddit(self.config['bot_subreddit'])
-        self.submission_writer = threading.Thread(target=self.submission_loop, args=())
-        self.submission_reader = threading.Thread(target=self.watch_submissions, args=())
-        self.inbox_reader = threading.Thread(target=self.watch_inbox, args=())
+        # bot_subreddit may be one name, a list, or "a+b+c"; all are read through one combined stream
+        subreddits = self.config['bot_subreddit']
+        self.subreddits = subreddits.split('+') if isinstance(subreddits, str) else list(subreddits)
+        self.sub = self.reddit.subreddit('+'.join(self.subreddits))
+        self.subs = {name.lower(): self.reddit.subreddit(name) for name in self.subreddits}
+        self.subreddit_settings = {str(name).lower(): settings or {} for name, settings in (self.config.get('subreddit_settings') or {}).items()}
+        self.sub_counts = {name.lower(): Counter() for name in self.subreddits}
+        self.submission_writer = threading.Thread(target=self.submission_loop, args=(), name='submission_writer')
+        self.submission_reader = threading.Thread(target=self.watch_submissions, args=(), name='submission_reader')
+        self.inbox_reader = threading.Thread(target=self.watch_inbox, args=(), name='inbox_reader')
         self.today = date.today()
         self.tally = 0 # to compare with daily input character budget
+        self.budget_lock = threading.RLock()
+        self.things = ThingStore(self.reddit)
         self.SSI = TaggingMixin() # handler for legacy SSI tagging functions
+        self.SSI.thing_store = self.things
         self.negative_keywords = _negative_keywords + self.config['negative_keywords']
+        self.text_pool = TextPool(self.negative_keywords, self.config.get('text_processes', 0), self.config.get('text_batch_size', 16))
+        self.SSI.text_pool = self.text_pool
         self.perspective = discovery.build(
          "commentanalyzer",
          "v1alpha1",
@@ -130,10 +113,99 @@ class reddit_bot:
          discoveryServiceUrl="https://commentanalyzer.googleapis.com/$discovery/rest?version=v1alpha1",
          static_discovery=False,
         )
+        self.topic_matcher = None
+        if self.config.get('topic_matcher') == 'embedding':
+            self.topic_matcher = TopicMatcher(
+                load_embedder(self.config.get('topic_embedding_model')),
+                self.config.get('topic_embedding_threshold', self.config['topic_threshold']),
+            )
+            self.topic_matcher.set_topics(self.topic_list)
+        self.moderation = ModerationEngine(
+            self.config['toxicity_threshold'],
+            self.perspective_score,
+            load_local_model(self.config.get('local_toxicity_model')),
+            self.config.get('toxicity_band', 0.2),
+            self.config.get('toxicity_score_log'),
+        )
+        self.sampler = None
+        if self.config.get('adaptive_samples'):
+            adaptive = self.config['adaptive_samples']
+            self.sampler = SampleController(
+                adaptive.get('min_samples', 1),
+                adaptive.get('max_samples', 4),
+                adaptive.get('sample_cost', 100),
+                adaptive.get('decay', 0.98),
+            )
         self.comments_seen = 0
         self.posts_seen = 0
         self.posts_made = 0
         self.comments_made = 0
+        self.inbox_acks = AckBuffer(self.reddit, self.config.get('inbox_ack_batch', 25), self.config.get('inbox_ack_seconds', 30))
+        atexit.register(self.inbox_acks.flush)
+        # atexit doesn't run on SIGTERM, which is how systemd and docker stop the bot
+        signal.signal(signal.SIGTERM, self.shutdown)
+        self.checkpoints = StreamCheckpoint(self.config.get('checkpoint_file') or '{}_checkpoints.json'.format(self.config['bot_username']))
+        self.outbox = WriteQueue(
+            self.reddit,
+            self.config.get('write_queue_file') or '{}_outbox.json'.format(self.config['bot_username']),
+            on_written=self.on_written,
+            min_interval=self.config.get('write_interval', 0),
+        )
+        self.build_filters()
+        self.profiler = SamplingProfiler(self.config.get('profile_dir', '.'), self.config.get('profile_interval', 0.01))
+        if hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, lambda signum, frame: log.info(self.profiler.toggle()))
+        if self.config.get('profile_control_file'):
+            self.profiler.watch_control_file(self.config['profile_control_file'])
+
+    def build_filters(self):
+        # each chain runs its cheapest checks first, so most items are
+        # rejected before any Perspective or inference API call is made
+        self.generation_filter = FilterChain('generation')
+        self.generation_filter.add('bad_keyword', COST_REGEX, lambda text: not self.bad_keyword(text))
+        self.generation_filter.add('is_toxic', COST_NETWORK, lambda text: not self.is_toxic(text))
+        self.title_filter = FilterChain('title')
+        self.title_filter.add('title_length', COST_LOCAL, lambda text: len(text)<=300) # Reddit's limit for post titles
+        self.title_filter.add('bad_keyword', COST_REGEX, lambda text: not self.bad_keyword(text))
+        self.title_filter.add('is_toxic', COST_NETWORK, lambda text: not self.is_toxic(text))
+        self.submission_filter = FilterChain('submission')
+        self.submission_filter.add('own_post', COST_LOCAL, lambda submission: submission.author != self.me)
+        self.submission_filter.add('reply_queued', COST_LOCAL, lambda submission: not self.outbox.is_queued(submission.fullname))
+        self.submission_filter.add('linkpost_only', COST_LOCAL, lambda submission: not (self.setting(submission.subreddit,'linkpost_only')==1 and submission.is_self))
+        self.submission_filter.add('bad_keyword', COST_REGEX, lambda submission: not (self.bad_keyword(submission.title) or (submission.is_self and self.bad_keyword(submission.selftext))))
+        self.submission_filter.add('already_replied', COST_NETWORK, lambda submission: not self.already_replied(submission.comments))
+        self.submission_filter.add('is_toxic', COST_NETWORK, lambda submission: not (self.is_toxic(submission.title) or (submission.is_self and self.is_toxic(submission.selftext))))
+        topic_cost = COST_INDEX if self.topic_matcher else COST_PAID
+        self.submission_filter.add('on_topic', topic_cost, lambda submission: self.forced_comment(submission) or self.on_topic(submission.title,self.topics_for(submission.subreddit)))
+        self.inbox_filter = FilterChain('inbox')
+        self.inbox_filter.add('has_author', COST_LOCAL, lambda item: bool(item.author))
+        self.inbox_filter.add('reply_queued', COST_LOCAL, lambda item: not self.outbox.is_queued(item.fullname))
+        self.inbox_filter.add('bad_keyword', COST_REGEX, lambda item: not self.bad_keyword(item.body))
+        self.inbox_filter.add('within_budget', COST_REGEX, lambda item: self.forced_reply(item) or (self.check_budget(item.body) and words_below(item.body, 1000)))
+        self.inbox_filter.add('already_replied', COST_NETWORK, lambda item: not self.already_replied(item.replies))
+        self.inbox_filter.add('is_toxic', COST_NETWORK, lambda item: not self.is_toxic(item.body))
+        self.inbox_filter.add('on_topic', topic_cost, lambda item: self.forced_reply(item) or self.on_topic(item.body,self.reply_topics(item)))
+        self.filter_chains = [self.generation_filter, self.title_filter, self.submission_filter, self.inbox_filter]
+
+    def setting(self,subreddit,key):
+        # per-subreddit override from subreddit_settings, else the top-level config value;
+        # flair ids and the post schedule belong to the first subreddit, so others only get their own
+        settings = self.subreddit_settings.get(str(subreddit).lower(), {})
+        if key in settings:
+            return settings[key]
+        if key in ('post_flair', 'post_schedule') and str(subreddit).lower() != self.subreddits[0].lower():
+            return None
+        return self.config[key]
+
+    def topics_for(self,subreddit):
+        settings = self.subreddit_settings.get(str(subreddit).lower(), {})
+        return settings.get('topic_list') or self.topic_list
+
+    def count(self,subreddit,key):
+        # bump a status counter, both in total and for the subreddit it happened in
+        setattr(self, key, getattr(self, key) + 1)
+        if subreddit is not None and str(subreddit).lower() in self.sub_counts:
+            self.sub_counts[str(subreddit).lower()][key] += 1
 
     def report_status(self):
         status = {}
@@ -142,50 +214,130 @@ class reddit_bot:
         status['posts_made'] = self.posts_made
         status['comments_made'] = self.comments_made
         status['percent'] = round(100*(self.tally/self.config['character_budget']))
-        print("READ: submissions={posts_seen}\tcomment={comments_seen}\t| WRITE: post={posts_made}\treply={comments_made}\t| SPEND={percent}%".format(**status))
+        line = "READ: submissions={posts_seen}\tcomment={comments_seen}\t| WRITE: post={posts_made}\treply={comments_made}\t| SPEND={percent}%".format(**status)
+        if len(self.subreddits) > 1:
+            status['subreddits'] = {name: dict(counts) for name, counts in self.sub_counts.items()}
+            line += ''.join("\t| r/{}: read={}/{} write={}/{}".format(name, counts['posts_seen'], counts['comments_seen'], counts['posts_made'], counts['comments_made']) for name, counts in self.sub_counts.items())
+        log.info(line, extra={'fields': status})
+        for chain in self.filter_chains:
+            chain.report()
+        log.debug("Toxicity decisions: %s", self.moderation.stats, extra={'fields': {'toxicity_decisions': dict(self.moderation.stats)}})
+        if self.sampler:
+            log.debug("Sample acceptance rates: %s", self.sampler.stats(), extra={'fields': {'acceptance': self.sampler.stats()}})
+
+    def on_written(self,entry,result):
+        # called by the write queue once a queued post or reply has actually been made
+        if entry['kind']=='submit':
+            log.info("Post successful!")
+            self.count(entry.get('subreddit'), 'posts_made')
+        else:
+            log.info("Reply successful!")
+            self.count(entry.get('subreddit'), 'comments_made')
+        self.report_status()
+
+    def textgen_parameters(self,key,model,path,prompt):
+        # copy of the configured generation parameters, with the sample count tuned to the path's acceptance rate
+        params = dict(self.config[key])
+        if self.sampler:
+            params['num_return_sequences'] = self.sampler.samples(model,path,len(prompt))
+        return params
+
+    def record_sample(self,model,path,accepted):
+        if self.sampler:
+            self.sampler.record(model,path,accepted)
 
     def bad_keyword(self,text):
-        return [keyword for keyword in self.negative_keywords if re.search(r"\b{}\b".format(keyword), text, re.IGNORECASE)]
+        return find_bad_keywords(text)
 
+    @tag_stage('is_toxic')
     def is_toxic(self,text):
+        return self.moderation.is_toxic(text)
+
+    @tag_stage('perspective')
+    def perspective_score(self,text):
         analyze_request = {
          'comment': { 'text': text },
          'requestedAttributes': {'TOXICITY': {}},
          'languages': 'en'
         }
-        try:
-            response = self.perspective.comments().analyze(body=analyze_request).execute()
-        except:
-            print("Toxicity checking failed!")
-            return True
+        response = self.perspective.comments().analyze(body=analyze_request).execute()
         score = response['attributeScores']['TOXICITY']['summaryScore']['value']
-        print(f"Perspective toxicity summary score = {score}")
-        if score>self.config['toxicity_threshold']:
-            return True
+        log.debug("Perspective toxicity summary score = %s", score, extra={'fields': {'toxicity': score, 'tier': 'perspective'}})
+        return score
+
+    def is_profile_command(self,item):
+        # the bot operator can toggle the profiler by messaging the bot the profile command
+        return bool(self.config.get('bot_operator')) and item.author and item.author.name==self.config['bot_operator'] and item.body.strip()==self.config.get('profile_command', '!profile')
+
+    def hydrate_inbox(self,items):
+        # one reddit.info() call per 100 parents/submissions for the whole batch
+        # instead of a lazy fetch per item when the thread is walked
+        comments = [item for item in items if not isinstance(item, praw_Message)]
+        self.things.hydrate(comments, self.config.get('hydrate_depth', 2))
+        if self.topic_matcher:
+            self.topic_matcher.prefetch([item.body for item in comments])
+
+    def hydrate_submissions(self,submissions):
+        # embed the whole batch of titles in one pass
+        if self.topic_matcher:
+            self.topic_matcher.prefetch([submission.title for submission in submissions])
+
+    def already_replied(self,comment_forest):
+        comment_forest.replace_more(limit=None)
+        for comment in comment_forest:
+            if comment.author == self.me:
+                return True
+        return False
+
+    def forced_comment(self,submission):
+        # image posts always get a comment when linkpost_only is 2
+        return self.setting(submission.subreddit,'linkpost_only')==2 and not submission.is_self
+
+    def forced_reply(self,item):
+        # top-level comments on the bot's posts always get a reply when force_top_reply is set
+        return item.parent_id[:2]=='t3' and self.setting(item.subreddit,'force_top_reply')
+
+    def reply_topics(self,item):
+        if item.was_comment:
+            # get the keywords of the thing to which the commenter was responding
+            item_parent = self.things.parent(item)
+            if item.parent_id[:2]=='t3':
+                topic_list = get_keywords(item_parent.title)
+            else:
+                topic_list = get_keywords(item_parent.body)
+            log.info("Parent keywords: %s", ", ".join(topic_list))
         else:
-            return False
+            # only possible option here is a mention in a submission
+            topic_list = self.topics_for(item.subreddit)
+            if not topic_list:
+                topic_list = get_keywords(self.bot_backstory)
+                log.info("Backstory keywords: %s", ", ".join(topic_list))
+        return topic_list
 
+    @tag_stage('on_topic')
     def on_topic(self,text,topic_list):
+        if self.topic_matcher:
+            # local embedding match; free, so not charged to the character budget
+            return self.topic_matcher.on_topic(text,topic_list)
         payload = {
             "inputs": text,
             "parameters": {"candidate_labels": topic_list,"multi_label": True},
             "options": {"use_cache": False, "wait_for_model": True}
         }
-        if not self.check_budget(text):
-            print("Not enough characters left in budget to check topic")
+        if not self.spend_budget(text):
+            log.warning("Not enough characters left in budget to check topic")
             return False
-        self.tally += len(text)
         self.report_status()
-        print(f'Checking text: {text}')
+        log_payload(log, 'Checking text', text)
         results = query(payload, self.config['topic_classifier'], self.headers)
         if not results:
-            print('Topic checking failed!')
+            log.warning('Topic checking failed!')
             return False
         for k in range(len(topic_list)):
             topic = topic_list[k]
             score = results['scores'][k]
             if score > self.config['topic_threshold']:
-                print('"{}": {}'.format(topic,round(score,1)))
+                log.info('"%s": %s', topic, round(score,1))
                 return True
         # otherwise
         return False
@@ -193,16 +345,26 @@ class reddit_bot:
     def check_budget(self,string):
         # check to see if an input string would exceed character budget
         # first, check the date; reset it and the tally if changed
-        if date.today() != self.today:
-            # reset the character budget and date
-            self.today = date.today()
-            self.tally = 0
-        character_cost = len(string)
-        if (self.tally + character_cost) < self.config['character_budget']:
+        with self.budget_lock:
+            if date.today() != self.today:
+                # reset the character budget and date
+                self.today = date.today()
+                self.tally = 0
+            character_cost = len(string)
+            if (self.tally + character_cost) < self.config['character_budget']:
+                return True
+            else:
+                return False
+
+    def spend_budget(self,string):
+        # check and charge the budget in one step, since posts can be generated on several threads at once
+        with self.budget_lock:
+            if not self.check_budget(string):
+                return False
+            self.tally += len(string)
             return True
-        else:
-            return False
 
+    @tag_stage('describe_image')
     def describe_image(self,url):
         # Settings below for Azure vision
         headers = {
@@ -226,11 +388,12 @@ class reddit_bot:
             #print(data)
             caption = 'A picture of ' + data['description']['captions'][0]['text']
             conn.close()
-            print("Caption: "+caption)
+            log.info("Caption: %s", caption)
         except Exception as e:
-            print(e)
+            log.warning("Image description failed: %s", e)
         return caption
 
+    @tag_stage('generate_image')
     def generate_image(self,prompt):
         endpoint = 'https://hf.space/embed/multimodalart/latentdiffusion/+/api/predict/'
         r = requests.post(url=endpoint, json={"data": [prompt,50,'256','256',1,1]})
@@ -250,10 +413,14 @@ class reddit_bot:
         url = r2_json['output_url']
         return url
 
-    def make_post(self):
+    @tag_stage('make_post')
+    def make_post(self, subreddit=None):
+        # post to the given subreddit, or the first one configured
+        sub = self.subs[(subreddit or self.subreddits[0]).lower()]
+        flair_id = self.setting(sub.display_name,'post_flair')
         if not self.config['post_textgen_model']:
             # if no fine-tuned model is given for posts, use the one-shot reply model
-            submission = self.build_post()
+            submission = self.build_post(sub)
             return submission
         for attempt in range(self.config['post_tries']):
             # ssi-bot style GPT-2 model text post generation
@@ -261,127 +428,113 @@ class reddit_bot:
                 prompt = '<|sols'
             else:
                 prompt = '<|soss'
-            if not self.check_budget(prompt):
-                print("Not enough characters left in budget to make a post!")
+            if not self.spend_budget(prompt):
+                log.warning("Not enough characters left in budget to make a post!")
                 return None
-            self.tally += len(prompt)
             self.report_status()
-            print("Generating a post on r/"+self.sub.display_name)
-            post_params = self.config['post_textgen_parameters']
-            stringlist = generate_text(prompt,self.config['post_textgen_model'],post_params,self.headers)
+            log.info("Generating a post on r/%s", sub.display_name)
+            model = self.config['post_textgen_model']
+            post_params = self.textgen_parameters('post_textgen_parameters',model,'make_post',prompt)
+            stringlist = generate_text(prompt,model,post_params,self.headers)
             if not stringlist:
-                print("Text generation failed!")
+                log.warning("Text generation failed!")
                 return None
             for generated_text in stringlist:
-                print(f"GENERATED: {generated_text}")
-                if self.bad_keyword(generated_text) or self.is_toxic(generated_text):
-                    print("Generated text failed toxicity check, discarded.")
+                log_payload(log, 'GENERATED', generated_text)
+                if not self.generation_filter.passes(generated_text):
+                    log.info("Generated text failed toxicity check, discarded.")
+                    self.record_sample(model,'make_post',False)
                     continue
                 post = self.SSI.extract_submission_from_generated_text(generated_text)
                 if not post:
-                    print("Failed to extract post from generated text!")
+                    log.warning("Failed to extract post from generated text!")
+                    self.record_sample(model,'make_post',False)
                     continue
+                self.record_sample(model,'make_post',True)
                 if prompt == '<|soss':
                     if 'selftext' not in post.keys():
-                        submission = self.sub.submit(title=post['title'],selftext='',flair_id=self.config['post_flair'])
+                        submission = self.outbox.submit(sub,title=post['title'],selftext='',flair_id=flair_id)
                     else:
-                        submission = self.sub.submit(title=post['title'],selftext=post['selftext'],flair_id=self.config['post_flair'])
+                        submission = self.outbox.submit(sub,title=post['title'],selftext=post['selftext'],flair_id=flair_id)
                 else:
                     post['url'] = self.generate_image(post['title'])
-                    submission = self.sub.submit(title=post['title'],url=post['url'],flair_id=self.config['post_flair'])
-                print("Post successful!")
-                self.posts_made += 1
-                self.report_status()
+                    submission = self.outbox.submit(sub,title=post['title'],url=post['url'],flair_id=flair_id)
                 return submission
         # if none of the posts passed the checks
         return None
 
-    def build_post(self):
+    @tag_stage('build_post')
+    def build_post(self, sub):
+        flair_id = self.setting(sub.display_name,'post_flair')
         for attempt in range(self.config['post_tries']):
             # one-shot post generation
             prompt = self.bot_backstory
             prompt = '\n'.join([prompt,'Title of a Reddit post by u/{}: "'.format(self.config['bot_username'])])
-            if not self.check_budget(prompt):
-                print("Not enough characters left in budget to make a post!")
+            if not self.spend_budget(prompt):
+                log.warning("Not enough characters left in budget to make a post!")
                 return None
-            self.tally += len(prompt)
-            print("Generating a post on r/"+self.sub.display_name)
+            log.info("Generating a post on r/%s", sub.display_name)
             # use the reply model to generate post title
-            post_params = self.config['reply_textgen_parameters']
-            stringlist = generate_text(prompt,self.config['reply_textgen_model'],post_params,self.headers)
+            model = self.config['reply_textgen_model']
+            post_params = self.textgen_parameters('reply_textgen_parameters',model,'build_post',prompt)
+            stringlist = generate_text(prompt,model,post_params,self.headers)
             if not stringlist:
-                print("Text generation failed!")
+                log.warning("Text generation failed!")
                 return None
             post = {}
-            for generated_text in stringlist:
-                # post titles should be a single line
-                truncate = generated_text.rfind('\n')
-                if truncate>-1:
-                    generated_text = generated_text[:truncate+1]
-                cleanStr = clean_text(generated_text)
+            for cleanStr in self.text_pool.map(clean_title, stringlist):
                 if not cleanStr:
-                    print("Invalid generation, skipping...")
+                    log.info("Invalid generation, skipping...")
+                    self.record_sample(model,'build_post',False)
                     continue
-                if len(cleanStr)>300:
-                    print("Generated text too long for Reddit post title, skipping")
-                    continue
-                print(f"GENERATED: {cleanStr}")
-                if self.bad_keyword(cleanStr) or self.is_toxic(cleanStr):
-                    print("Generated text failed toxicity check, discarded.")
+                log_payload(log, 'GENERATED', cleanStr)
+                rejected = self.title_filter.run(cleanStr)
+                if rejected:
+                    log.info("Generated title rejected by %s filter, discarded.", rejected)
+                    self.record_sample(model,'build_post',False)
                     continue
+                self.record_sample(model,'build_post',True)
                 post['title'] = cleanStr
             if 'title' not in post.keys():
-                print("Unable to generate an acceptable post title!")
+                log.warning("Unable to generate an acceptable post title!")
                 return None
             if random.random()<self.config['linkpost_share']:
                 post['url'] = self.generate_image(post['title'])
-                try:
-                    submission = self.sub.submit(title=post['title'],url=post['url'],flair_id=self.config['post_flair'])
-                    return submission
-                except:
-                    print("Post unsuccessful...")
-                    continue
+                submission = self.outbox.submit(sub,title=post['title'],url=post['url'],flair_id=flair_id)
+                return submission
             else:
                 prompt = prompt + post['title'] + '"'
                 prompt = '\n'.join([prompt,'Post body: "'.format(self.config['bot_username'])])
-                if not self.check_budget(prompt):
-                    print("Not enough characters left in budget to generate post body!")
+                if not self.spend_budget(prompt):
+                    log.warning("Not enough characters left in budget to generate post body!")
                     return None
                 else:
-                    self.tally += len(prompt)
-                    stringlist = generate_text(prompt,self.config['reply_textgen_model'],post_params,self.headers)
-                    for generated_text in stringlist:
-                        cleanStr = clean_text(generated_text)
+                    post_params = self.textgen_parameters('reply_textgen_parameters',model,'build_post_body',prompt)
+                    stringlist = generate_text(prompt,model,post_params,self.headers)
+                    for cleanStr in self.text_pool.map(clean_text, stringlist):
                         if not cleanStr:
-                            print("Invalid generation, skipping...")
+                            log.info("Invalid generation, skipping...")
+                            self.record_sample(model,'build_post_body',False)
                             continue
-                        print(f"GENERATED: {cleanStr}")
-                        if self.bad_keyword(cleanStr) or self.is_toxic(cleanStr):
-                            print("Generated text failed toxicity check, discarded.")
+                        log_payload(log, 'GENERATED', cleanStr)
+                        if not self.generation_filter.passes(cleanStr):
+                            log.info("Generated text failed toxicity check, discarded.")
+                            self.record_sample(model,'build_post_body',False)
                             continue
+                        self.record_sample(model,'build_post_body',True)
                         post['selftext'] = cleanStr
                 if 'selftext' not in post.keys():
-                    try:
-                        submission = self.sub.submit(title=post['title'],selftext='',flair_id=self.config['post_flair'])
-                    except:
-                        print("Post unsuccessful...")
-                        continue
+                    submission = self.outbox.submit(sub,title=post['title'],selftext='',flair_id=flair_id)
                 else:
-                    try:
-                        submission = self.sub.submit(title=post['title'],selftext=post['selftext'],flair_id=self.config['post_flair'])
-                    except:
-                        print("Post unsuccessful...")
-                        continue
-                print("Post successful!")
-                self.posts_made += 1
-                self.report_status()
+                    submission = self.outbox.submit(sub,title=post['title'],selftext=post['selftext'],flair_id=flair_id)
                 return submission
             time.sleep(900) # wait fifteen minutes
         # if none of the posts passed the checks
         return None
 
+    @tag_stage('generate_reply')
     def generate_reply(self, comment):
-        print("Generating a reply to comment:\n"+comment.body)
+        log_payload(log, 'Generating a reply to comment', comment.body)
         reply = None
         # accumulate comment thread for context
         at_top = False
@@ -393,7 +546,7 @@ class reddit_bot:
                 # next thing is the post, not a comment
                 # To do: image recognition/description for link posts
                 at_top = True
-                thread_post = comment.submission
+                thread_post = self.things.submission(comment)
                 thread_OP = thread_post.author.name
                 post_title = thread_post.title
                 if thread_post.is_self:
@@ -404,48 +557,48 @@ class reddit_bot:
                     prompt = '\n'.join(['Image post by u/{} titled "{}": {}'.format(thread_OP,post_title,alt_text),prompt])
                 break
             else:
-                thread_item = thread_item.parent()
+                thread_item = self.things.parent(thread_item)
         # if not at_top:
-        #     print("Post not in prompt, discarding")
+        #     log.info("Post not in prompt, discarding")
         #     return None
         prompt = '\n'.join([self.bot_backstory,prompt])
-        if not self.check_budget(prompt):
-            print("Prompt is too long, skipping...")
+        if not self.spend_budget(prompt):
+            log.info("Prompt is too long, skipping...")
             return None
-        self.tally += len(prompt)
         self.report_status()
-        print(f"PROMPT: {prompt}")
-        reply_params = self.config['reply_textgen_parameters']
+        log_payload(log, 'PROMPT', prompt)
+        model = self.config['reply_textgen_model']
+        reply_params = self.textgen_parameters('reply_textgen_parameters',model,'generate_reply',prompt)
         try:
-            stringlist = generate_text(prompt,self.config['reply_textgen_model'],reply_params,self.headers)
+            stringlist = generate_text(prompt,model,reply_params,self.headers)
         except:
-            print("Generation failed, skipping...")
+            log.warning("Generation failed, skipping...")
             return None
         if not stringlist:
-            print("Generation failed, skipping...")
+            log.warning("Generation failed, skipping...")
             return None
-        for generated_text in stringlist:
-            cleanStr = clean_text(generated_text)
+        for cleanStr in self.text_pool.map(clean_text, stringlist):
             if not cleanStr:
-                print("Invalid generation, skipping...")
+                log.info("Invalid generation, skipping...")
+                self.record_sample(model,'generate_reply',False)
                 continue
-            print(f"GENERATED: {cleanStr}")
-            if self.is_toxic(cleanStr):
-                print("Text is toxic, skipping...")
+            log_payload(log, 'GENERATED', cleanStr)
+            if not self.generation_filter.passes(cleanStr):
+                log.info("Text is toxic, skipping...")
+                self.record_sample(model,'generate_reply',False)
                 continue
-            reply = comment.reply(body=clean_text(cleanStr)) # sometimes need a 2nd wash
-            print("Reply successful!")
-            self.comments_made += 1
-            self.report_status()
+            self.record_sample(model,'generate_reply',True)
+            reply = self.outbox.reply(comment, clean_text(cleanStr)) # sometimes need a 2nd wash
             return reply
         return None # No valid replies
 
+    @tag_stage('make_comment')
     def make_comment(self, submission):
         comment = None
         # reply to a submission
         thread_OP = submission.author.name
         post_title = submission.title
-        print("Commenting on submission:\n"+post_title)
+        log.info("Commenting on submission: %s", post_title)
         prompt = 'Comment by u/{}: "'.format(self.config['bot_username'])
         if submission.is_self:
             post_body = submission.selftext
@@ -454,83 +607,73 @@ class reddit_bot:
             alt_text = self.describe_image(submission.url)
             prompt = '\n'.join(['Image post by u/{} titled "{}": {}'.format(thread_OP,post_title,alt_text),prompt])
         prompt = '\n'.join([self.bot_backstory,prompt])
-        if not self.check_budget(prompt):
-            print("Prompt is too long, skipping...")
+        if not self.spend_budget(prompt):
+            log.info("Prompt is too long, skipping...")
             return None
-        self.tally += len(prompt)
         self.report_status()
-        print(f"PROMPT: {prompt}")
-        reply_params = self.config['reply_textgen_parameters']
-        stringlist = generate_text(prompt,self.config['reply_textgen_model'],reply_params,self.headers)
+        log_payload(log, 'PROMPT', prompt)
+        model = self.config['reply_textgen_model']
+        reply_params = self.textgen_parameters('reply_textgen_parameters',model,'make_comment',prompt)
+        stringlist = generate_text(prompt,model,reply_params,self.headers)
         if not stringlist:
-            print("Generation failed, skipping...")
+            log.warning("Generation failed, skipping...")
             return None
-        for generated_text in stringlist:
-            cleanStr = clean_text(generated_text)
+        for cleanStr in self.text_pool.map(clean_text, stringlist):
             if not cleanStr:
-                print("Invalid generation, skipping...")
-                return None
-            print(f"GENERATED: {cleanStr}")
-            if self.is_toxic(cleanStr) or self.bad_keyword(cleanStr):
-                print("Text is toxic, skipping...")
+                log.info("Invalid generation, skipping...")
+                self.record_sample(model,'make_comment',False)
+                continue
+            log_payload(log, 'GENERATED', cleanStr)
+            if not self.generation_filter.passes(cleanStr):
+                log.info("Text is toxic, skipping...")
+                self.record_sample(model,'make_comment',False)
             else:
-                try:
-                    reply = submission.reply(body=cleanStr)
-                    print("Comment successful!")
-                    self.comments_made += 1
-                    self.report_status()
-                    return reply
-                except:
-                    print("Comment failed, sorry...")
-                    return None
+                self.record_sample(model,'make_comment',True)
+                reply = self.outbox.reply(submission, cleanStr)
+                return reply
         # no valid replies
         return None
 
     def watch_submissions(self):
         # watch for posts
+        failures = 0
         while True:
             try:
-                for submission in self.sub.stream.submissions(pause_after=0,skip_existing=True):
+                for submission in checkpointed_stream(self.reddit, 'r/{}/new'.format(self.sub.display_name), self.sub.stream.submissions, self.checkpoints, 'submissions', self.config.get('catch_up_pages', 10), self.hydrate_submissions):
                     # decide whether to reply to a post
                     if not submission:
+                        failures = 0 # stream is idle again, so whatever failed has passed
                         continue
-                    self.posts_seen += 1
-                    if submission.author == self.me:
-                        continue
-                    if self.bad_keyword(submission.title) or (submission.is_self and self.bad_keyword(submission.selftext)):
-                        continue
-                    if self.is_toxic(submission.title) or (submission.is_self and self.is_toxic(submission.selftext)):
+                    self.count(submission.subreddit, 'posts_seen')
+                    rejected = self.submission_filter.run(submission)
+                    if rejected:
+                        log.debug("Submission %s rejected by %s filter", submission.id, rejected)
                         continue
-                    if self.config['linkpost_only']==2 and not submission.is_self:
-                        # force reply to image posts
-                        self.make_comment(submission)
-                        continue
-                    elif self.config['linkpost_only']==1 and submission.is_self:
-                        continue
-                    already_replied = False
-                    submission.comments.replace_more(limit=None)
-                    for comment in submission.comments:
-                        if comment.author == self.reddit.user.me():
-                            already_replied = True
-                            break
-                    if already_replied:
-                        continue
-                    if self.on_topic(submission.title,self.topic_list):
-                        print("Generating a comment on submission "+submission.id)
-                        self.make_comment(submission)
+                    log.info("Generating a comment on submission %s", submission.id)
+                    self.make_comment(submission)
             except:
-                print("PRAW error, restarting")
+                failures += 1
+                log.exception("PRAW error, restarting")
+                time.sleep(min(300, 5 * 2**failures))
 
     def watch_inbox(self):
+        failures = 0
         while True: # not sure if this line is necessary
             try:
-                for item in self.reddit.inbox.stream(pause_after=0, skip_existing=True):
+                # catch up from the full inbox listing, since items drop out of the unread one once marked read
+                for item in checkpointed_stream(self.reddit, 'message/inbox', self.reddit.inbox.stream, self.checkpoints, 'inbox', self.config.get('catch_up_pages', 10), self.hydrate_inbox):
                     if not item:
+                        failures = 0 # stream is idle again, so whatever failed has passed
+                        self.inbox_acks.tick()
                         continue
                     if isinstance(item, praw_Message):
                         # it's actually a message
+                        if self.is_profile_command(item):
+                            item.reply(body=self.profiler.toggle())
+                            self.inbox_acks.add(item)
+                            continue
                         # if item.author.name==self.config['bot_operator'] and (self.config['kill_phrase'] in item.body):
-                        #     item.mark_read()
+                        #     self.inbox_acks.add(item)
                         #     self.shutdown()
                         if self.config['dynamic_prompt']:
                             if item.subject and item.body:
@@ -543,96 +686,66 @@ class reddit_bot:
                                     self.topic_list = user_topic_list
                                 else:
                                     self.topic_list = get_keywords(self.bot_backstory)
+                                if self.topic_matcher:
+                                    self.topic_matcher.set_topics(self.topic_list)
                                 status = 'Backstory changed to: {} with interests {}'.format(self.bot_backstory,self.topic_list)
-                                print(status)
+                                log.info(status)
                                 item.reply(body=status)
                                 self.me.subreddit.submit(title='Bot updated by {}'.format(item.author.name),selftext=status)
                                 self.make_post()
-                        item.mark_read()
+                        self.inbox_acks.add(item)
                         continue
-                    self.comments_seen += 1
-                    if not item.author:
-                        item.mark_read()
-                        continue
-                    if self.bad_keyword(item.body):
-                        print("Bad keyword found, skipping...")
-                        item.mark_read()
-                        continue
-                    if self.is_toxic(item.body):
-                        print("Comment is toxic, skipping...")
-                        item.mark_read()
-                        continue
-                    already_replied = False
-                    item.replies.replace_more(limit=None)
-                    for reply in item.replies:
-                        if reply.author == self.me:
-                            already_replied = True
-                            break
-                    if already_replied:
-                        item.mark_read()
-                        continue
-                    print('Checking comment "{}"'.format(item.body))
-                    if item.parent_id[:2]=='t3' and self.config['force_top_reply']:
+                    self.count(item.subreddit, 'comments_seen')
+                    log_payload(log, 'Checking comment', item.body)
+                    rejected = self.inbox_filter.run(item)
+                    if rejected:
+                        log.info('Comment rejected by %s filter, skipping...', rejected)
+                    else:
                         self.generate_reply(item)
-                    elif self.check_budget(item.body) and words_below(item.body, 1000):
-                        if item.was_comment:
-                            # get the keywords of the thing to which the commenter was responding
-                            item_parent = item.parent()
-                            if item.parent_id[:2]=='t3':
-                                topic_list = get_keywords(item_parent.title)
-                            else:
-                                topic_list = get_keywords(item_parent.body)
-                            print("Parent keywords: "+", ".join(topic_list))
-                        else:
-                            # only possible option here is a mention in a submission
-                            if not self.topic_list:
-                                topic_list = get_keywords(self.bot_backstory)
-                                print("Backstory keywords: "+", ".join(topic_list))
-                            else:
-                                topic_list = self.topic_list
-                        if self.on_topic(item.body,topic_list):
-                            self.generate_reply(item)
-                    print('Comment not selected for reply, skipping...')
-                    item.mark_read()
+                    self.inbox_acks.add(item)
             except:
-                print("PRAW error, restarting")
+                failures += 1
+                log.exception("PRAW error, restarting")
+                self.inbox_acks.flush()
+                time.sleep(min(300, 5 * 2**failures))
 
     def submission_loop(self):
-        for t in self.config['post_schedule']['mon']:
-            schedule.every().monday.at(t).do(self.make_post)
-        for t in self.config['post_schedule']['tue']:
-            schedule.every().tuesday.at(t).do(self.make_post)
-        for t in self.config['post_schedule']['wed']:
-            schedule.every().wednesday.at(t).do(self.make_post)
-        for t in self.config['post_schedule']['thu']:
-            schedule.every().thursday.at(t).do(self.make_post)
-        for t in self.config['post_schedule']['fri']:
-            schedule.every().friday.at(t).do(self.make_post)
-        for t in self.config['post_schedule']['sat']:
-            schedule.every().saturday.at(t).do(self.make_post)
-        for t in self.config['post_schedule']['sun']:
-            schedule.every().sunday.at(t).do(self.make_post)
-        while True:
-            schedule.run_pending()
-            time.sleep(1)
+        self.post_scheduler = PostScheduler(
+            timezone=self.config.get('post_timezone'),
+            jitter=self.config.get('post_jitter', 0),
+            workers=self.config.get('post_workers', 2),
+        )
+        for name in self.subreddits:
+            if self.setting(name,'post_schedule'):
+                self.post_scheduler.add(functools.partial(self.make_post, name), self.setting(name,'post_schedule'))
+        self.post_scheduler.run()
 
     def run(self):
-        print("Bot named {} running on {}".format(self.config['bot_username'],self.config['bot_subreddit']))
-        if not self.config['post_schedule']:
-            print("No posts scheduled!")
+        log.info("Bot named %s running on %s", self.config['bot_username'], ", ".join(self.subreddits))
+        if not any(self.setting(name,'post_schedule') for name in self.subreddits):
+            log.info("No posts scheduled!")
         else:
-            print("Launching submission writer")
+            log.info("Launching submission writer")
             self.submission_writer.start()
         # don't bother running submission reader if bot has no interests
         if self.config['read_posts']:
-            print("Scanning for posts on the following topics: "+", ".join(self.topic_list))
+            log.info("Scanning for posts on the following topics: %s", ", ".join(self.topic_list))
             self.submission_reader.start()
         else:
-            print("Bot will not read submissions.")
-        print("Launching inbox reader")
+            log.info("Bot will not read submissions.")
+        log.info("Launching write queue")
+        self.outbox.start()
+        log.info("Launching inbox reader")
         self.inbox_reader.start()
 
-    def shutdown(self):
+    def shutdown(self, signum=None, frame=None):
+        log.info("Shutting down")
+        self.inbox_acks.flush()
+        self.text_pool.shutdown()
+        if signum is not None:
+            # called as a signal handler; the reader threads never return, so don't wait for them
+            stop_logging()
+            os._exit(0)
         sys.exit()
 
 def main():
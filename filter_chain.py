@@ -0,0 +1,56 @@
+import threading
+import time
+from log_utils import get_logger
+from profiler import stage
+
+log = get_logger('filter_chain')
+
+# Relative cost of a check; the chain always runs the cheapest ones first
+COST_LOCAL = 0 # attribute comparisons, config lookups
+COST_REGEX = 1 # local regex/tokenizer passes over the text
+COST_INDEX = 2 # lookups against local indexes/caches
+COST_NETWORK = 3 # free-but-slow remote calls (Reddit, Perspective)
+COST_PAID = 4 # calls charged to the inference budget
+
+class FilterChain:
+    # Ordered set of pass/reject checks which short-circuits on the first rejection
+    # and records how often each check passes or rejects and how long it takes
+    def __init__(self, name):
+        self.name = name
+        self.filters = []
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def add(self, name, cost, check):
+        # check(item) returns True if the item should go on to the next filter
+        self.filters.append((cost, len(self.filters), name, check))
+        self.filters.sort()
+        self.stats[name] = {'passed': 0, 'rejected': 0, 'seconds': 0.0}
+        return self
+
+    def run(self, item):
+        # returns the name of the filter that rejected the item, or None if it passed all of them
+        for cost, order, name, check in self.filters:
+            start = time.perf_counter()
+            with stage('{}:{}'.format(self.name, name)):
+                passed = check(item)
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                stat = self.stats[name]
+                stat['seconds'] += elapsed
+                if passed:
+                    stat['passed'] += 1
+                else:
+                    stat['rejected'] += 1
+            if not passed:
+                return name
+        return None
+
+    def passes(self, item):
+        return self.run(item) is None
+
+    def report(self):
+        with self.lock:
+            stats = {name: dict(stat) for name, stat in self.stats.items()}
+        summary = ', '.join('{}: {}/{} in {:.1f}s'.format(name, s['rejected'], s['passed']+s['rejected'], s['seconds']) for name, s in stats.items())
+        log.debug("Filter chain %s rejections: %s", self.name, summary, extra={'fields': {'chain': self.name, 'filters': stats}})
@@ -1,6 +1,9 @@
 import requests
 import time
 import re
+from log_utils import get_logger
+
+log = get_logger('hf_utils')
 
 # function for Huggingface API calls
 def query(payload, model_path, headers):
@@ -12,25 +15,22 @@ def query(payload, model_path, headers):
                 results = response.json()
                 return results
             except:
-                print('Invalid response received from server')
-                print(response)
+                log.error('Invalid response received from server: %s', response)
                 return None
         else:
             # Not connected to internet maybe?
             if response.status_code==404:
-                print('Are you connected to the internet?')
-                print('URL attempted = '+API_URL)
+                log.error('Are you connected to the internet? URL attempted = %s', API_URL)
                 break
             if response.status_code==503:
-                print(response.json()['error'])
+                log.warning(response.json()['error'])
                 time.sleep(response.json()['estimated_time'])
                 continue
             if response.status_code==504:
-                print('504 Gateway Timeout')
+                log.warning('504 Gateway Timeout')
             else:
-                print('Unsuccessful request, status code '+ str(response.status_code))
-                # print(response.json()) #debug only
-                print(payload)
+                log.warning('Unsuccessful request, status code %s', response.status_code)
+                log.debug('Failed payload: %s', payload)
 
 def generate_text(prompt, model_path, text_generation_parameters, headers):
     start_time = time.time()
@@ -38,14 +38,14 @@ def generate_text(prompt, model_path, text_generation_parameters, headers):
     payload = {"inputs": prompt, "parameters": text_generation_parameters, "options": options}
     output_list = query(payload, model_path, headers)
     if not output_list:
-        print('Generation failed')
+        log.error('Generation failed')
     end_time = time.time()
     duration = round(end_time - start_time, 1)
     stringlist = []
     if output_list and 'generated_text' in output_list[0].keys():
-        print(f'{len(output_list)} sample(s) of text generated in {duration} seconds.')
+        log.info('%d sample(s) of text generated in %s seconds.', len(output_list), duration, extra={'fields': {'model': model_path, 'samples': len(output_list), 'seconds': duration}})
         for gendict in output_list:
             stringlist.append(gendict['generated_text'])
     else:
-        print(output_list)
+        log.warning('Unexpected generation output: %s', output_list)
     return(stringlist)
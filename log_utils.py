@@ -0,0 +1,86 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+
+# All bot loggers hang off this one so that a single queue handler serves
+# every thread; records are formatted and written by a background listener.
+_root_name = 'hotshot'
+_listener = None
+
+def get_logger(name):
+    return logging.getLogger('{}.{}'.format(_root_name, name))
+
+def log_payload(logger, label, text, level=logging.INFO):
+    # prompts and generations are verbose; tag them so they can be sampled/truncated
+    text = text or ''
+    logger.log(level, "%s: %s", label, text, extra={'payload': True, 'fields': {'kind': label.lower(), 'chars': len(text)}})
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'msg': record.getMessage(),
+        }
+        fields = getattr(record, 'fields', None)
+        if fields:
+            entry.update(fields)
+        return json.dumps(entry, default=str)
+
+class PayloadSampler(logging.Filter):
+    # drops a share of payload records and truncates the ones that are kept
+    def __init__(self, sample_rate=1.0, max_chars=0):
+        super().__init__()
+        self.sample_rate = sample_rate
+        self.max_chars = max_chars
+
+    def filter(self, record):
+        if not getattr(record, 'payload', False):
+            return True
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return False
+        if self.max_chars and record.args:
+            text = str(record.args[-1])
+            if len(text) > self.max_chars:
+                record.args = record.args[:-1] + (text[:self.max_chars] + '...',)
+        return True
+
+def setup_logging(config=None):
+    # (re)configure the shared queue logger from the bot config
+    global _listener
+    config = config or {}
+    stop_logging()
+    if config.get('log_format', 'text') == 'json':
+        formatter = JSONFormatter()
+    else:
+        formatter = logging.Formatter('%(asctime)s %(levelname)s [%(threadName)s] %(message)s')
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(formatter)
+    log_queue = queue.Queue(-1) # unbounded, so emitting never blocks a watcher thread
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(PayloadSampler(
+        config.get('log_payload_sample_rate', 1.0),
+        config.get('log_payload_max_chars', 0),
+    ))
+    root = logging.getLogger(_root_name)
+    root.handlers = [queue_handler]
+    root.setLevel(config.get('log_level', 'INFO').upper())
+    root.propagate = False
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    return root
+
+def stop_logging():
+    # flush whatever is still queued; safe to call more than once
+    global _listener
+    if _listener:
+        _listener.stop()
+        _listener = None
+
+atexit.register(stop_logging)
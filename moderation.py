@@ -0,0 +1,147 @@
+import json
+import math
+import re
+import sys
+import threading
+import zlib
+from log_utils import get_logger
+
+log = get_logger('moderation')
+
+_token_pattern = re.compile(r"\w+|[^\w\s]")
+
+def hashed_features(text, n_features):
+    # word unigrams and bigrams plus character trigrams, hashed into n_features buckets;
+    # crc32 rather than hash() so that indexes are stable between runs
+    tokens = _token_pattern.findall(text.lower())
+    grams = tokens + [a + ' ' + b for a, b in zip(tokens, tokens[1:])]
+    for token in tokens:
+        padded = '<' + token + '>'
+        grams.extend(padded[i:i+3] for i in range(len(padded) - 2))
+    counts = {}
+    for gram in grams:
+        index = zlib.crc32(gram.encode('utf-8')) % n_features
+        counts[index] = counts.get(index, 0) + 1
+    return counts
+
+class HashedLinearModel:
+    # Logistic regression over hashed n-grams: small, CPU-only and fast enough
+    # to score every string before deciding whether Perspective needs to see it
+    def __init__(self, n_features=2**18, bias=0.0, weights=None):
+        self.n_features = n_features
+        self.bias = bias
+        self.weights = weights or {}
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, 'r') as f:
+            data = json.load(f)
+        return cls(data['n_features'], data['bias'], {int(k): v for k, v in data['weights'].items()})
+
+    def save(self, filename):
+        with open(filename, 'w') as f:
+            json.dump({'n_features': self.n_features, 'bias': self.bias, 'weights': self.weights}, f)
+
+    def score(self, text):
+        z = self.bias + sum(self.weights.get(index, 0.0) * count for index, count in hashed_features(text, self.n_features).items())
+        return 1 / (1 + math.exp(-max(min(z, 30), -30)))
+
+    def fit(self, texts, labels, epochs=5, learning_rate=0.1, l2=1e-6):
+        # plain SGD; labels are toxicity probabilities, e.g. logged Perspective scores
+        for epoch in range(epochs):
+            for text, label in zip(texts, labels):
+                features = hashed_features(text, self.n_features)
+                gradient = self.score(text) - label
+                self.bias -= learning_rate * gradient
+                for index, count in features.items():
+                    weight = self.weights.get(index, 0.0)
+                    self.weights[index] = weight - learning_rate * (gradient * count + l2 * weight)
+        return self
+
+class DetoxifyModel:
+    # wrapper for the optional detoxify package (needs torch)
+    def __init__(self, variant='original'):
+        from detoxify import Detoxify
+        self.model = Detoxify(variant)
+
+    def score(self, text):
+        return float(self.model.predict(text)['toxicity'])
+
+def load_local_model(spec):
+    # spec is either "detoxify[:variant]" or the path of a saved HashedLinearModel
+    if not spec:
+        return None
+    if spec.startswith('detoxify'):
+        return DetoxifyModel(spec.partition(':')[2] or 'original')
+    model = HashedLinearModel.load(spec)
+    if not model.weights:
+        # an untrained model scores everything as sigmoid(bias) and would decide every text on its own
+        raise ValueError("Local toxicity model {} has no weights; train it with `python moderation.py <score log> {}`".format(spec, spec))
+    return model
+
+def read_score_log(filename):
+    # (texts, scores) from a JSON-lines file written by ModerationEngine
+    texts, scores = [], []
+    with open(filename, 'r') as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                texts.append(record['text'])
+                scores.append(record['score'])
+    return texts, scores
+
+def train(score_log, model_file, epochs=5):
+    # fit a HashedLinearModel to the Perspective scores logged by the bot
+    texts, scores = read_score_log(score_log)
+    if not texts:
+        raise ValueError("No scores in {}".format(score_log))
+    model = HashedLinearModel().fit(texts, scores, epochs)
+    model.save(model_file)
+    log.info("Trained on %d scored text(s), saved to %s", len(texts), model_file)
+    return model
+
+class ModerationEngine:
+    # Scores text with the local model first and only escalates to the remote scorer
+    # (Perspective) when the local score falls within `band` of the threshold.
+    # If the remote call fails, fail closed: escalated texts are exactly the ones the local
+    # model is unsure about, so its score can't decide them.
+    # Remote scores can be appended to score_log as training data for the local model.
+    def __init__(self, threshold, remote_score, local_model=None, band=0.2, score_log=None):
+        self.threshold = threshold
+        self.remote_score = remote_score
+        self.local_model = local_model
+        self.band = band
+        self.score_log = score_log
+        self.stats = {'local': 0, 'remote': 0, 'failed': 0}
+        self.lock = threading.Lock()
+
+    def count(self, outcome):
+        with self.lock:
+            self.stats[outcome] += 1
+
+    def record(self, text, score):
+        if not self.score_log:
+            return
+        with self.lock:
+            with open(self.score_log, 'a') as f:
+                f.write(json.dumps({'text': text, 'score': score}) + '\n')
+
+    def is_toxic(self, text):
+        local = self.local_model.score(text) if self.local_model else None
+        if local is not None and abs(local - self.threshold) > self.band:
+            self.count('local')
+            log.debug("Local toxicity score = %s", round(local, 3), extra={'fields': {'toxicity': local, 'tier': 'local'}})
+            return local > self.threshold
+        try:
+            score = self.remote_score(text)
+        except Exception:
+            self.count('failed')
+            log.warning("Toxicity checking failed!")
+            return True
+        self.count('remote')
+        self.record(text, score)
+        return score > self.threshold
+
+if __name__ == "__main__":
+    # python moderation.py <score log> <model file> [epochs]
+    train(sys.argv[1], sys.argv[2], *[int(arg) for arg in sys.argv[3:4]])
@@ -0,0 +1,89 @@
+import heapq
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+try:
+    from zoneinfo import ZoneInfo
+except ImportError:
+    # Python < 3.9; post_timezone is unavailable and the schedule runs on local time
+    ZoneInfo = None
+from log_utils import get_logger
+
+log = get_logger('post_scheduler')
+
+_weekdays = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+
+def parse_schedule(post_schedule):
+    # Accepts either a flat list of "HH:MM" times (posted every day)
+    # or a dict of per-day lists keyed by weekday ('mon', 'tuesday', ...)
+    # and returns a list of (weekday, hour, minute) slots
+    if isinstance(post_schedule, dict):
+        day_times = {}
+        for day, times in post_schedule.items():
+            weekday = _weekdays.index(str(day).lower()[:3])
+            day_times[weekday] = times or []
+    else:
+        day_times = {weekday: post_schedule or [] for weekday in range(7)}
+    slots = []
+    for weekday, times in day_times.items():
+        for t in times:
+            hour, minute = str(t).split(':')[:2]
+            slots.append((weekday, int(hour), int(minute)))
+    return slots
+
+class PostScheduler:
+    # Keeps the next due time of every slot in a heap and sleeps until the earliest one,
+    # handing each job to a worker pool so a slow post never delays the slots after it
+    def __init__(self, timezone=None, jitter=0, workers=2):
+        self.slots = [] # (weekday, hour, minute), job
+        if timezone and ZoneInfo is None:
+            log.warning("post_timezone needs Python 3.9+, using local time instead")
+            timezone = None
+        self.tz = ZoneInfo(timezone) if timezone else None # None means local time
+        self.jitter = jitter # seconds, applied in both directions
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='post_worker')
+        self.stopped = threading.Event()
+
+    def add(self, job, post_schedule):
+        # run job at every slot of the schedule
+        self.slots.extend((slot, job) for slot in parse_schedule(post_schedule))
+
+    def next_due(self, slot, after):
+        # first occurrence of the slot strictly after the given datetime
+        weekday, hour, minute = slot
+        due = after.replace(hour=hour, minute=minute, second=0, microsecond=0)
+        due += timedelta(days=(weekday - due.weekday()) % 7)
+        if due <= after:
+            due += timedelta(days=7)
+        return due
+
+    def run(self):
+        now = datetime.now(self.tz)
+        heap = []
+        for index, (slot, job) in enumerate(self.slots):
+            nominal = self.next_due(slot, now)
+            heapq.heappush(heap, (nominal.timestamp() + random.uniform(-self.jitter, self.jitter), index, nominal))
+        while heap and not self.stopped.is_set():
+            due, index, nominal = heap[0]
+            wait = due - datetime.now(self.tz).timestamp()
+            if wait > 0:
+                # wake exactly when the next slot is due (or when stopped)
+                self.stopped.wait(wait)
+                continue
+            heapq.heappop(heap)
+            log.info("Post slot %s due, dispatching", nominal.strftime('%a %H:%M'))
+            slot, job = self.slots[index]
+            self.executor.submit(self.run_job, job)
+            nominal = self.next_due(slot, nominal)
+            heapq.heappush(heap, (nominal.timestamp() + random.uniform(-self.jitter, self.jitter), index, nominal))
+
+    def run_job(self, job):
+        try:
+            job()
+        except Exception:
+            log.exception("Scheduled post failed")
+
+    def stop(self):
+        self.stopped.set()
+        self.executor.shutdown(wait=False)
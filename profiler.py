@@ -0,0 +1,113 @@
+import functools
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from log_utils import get_logger
+
+log = get_logger('profiler')
+
+# thread ident -> stack of stage names currently running on that thread;
+# each list is only ever mutated by its own thread, the sampler just reads it
+_stages = {}
+
+@contextmanager
+def stage(name):
+    stack = _stages.setdefault(threading.get_ident(), [])
+    stack.append(name)
+    try:
+        yield
+    finally:
+        stack.pop()
+
+def tag_stage(name):
+    # decorator form of stage(), for methods such as generate_reply or is_toxic
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+class SamplingProfiler:
+    # Samples the stacks of every bot thread at a fixed interval while enabled,
+    # and dumps them in collapsed-stack format (one "frame;frame;... count" per line)
+    # for flamegraph.pl, speedscope, inferno and similar tools
+    def __init__(self, output_dir='.', interval=0.01):
+        self.output_dir = output_dir
+        self.interval = interval
+        self.counts = Counter()
+        self.lock = threading.Lock()
+        self.running = threading.Event()
+        self.sampler = None
+
+    def start(self):
+        with self.lock:
+            if self.running.is_set():
+                return
+            self.counts = Counter()
+            self.running.set()
+            self.sampler = threading.Thread(target=self._sample_loop, name='profiler', daemon=True)
+            self.sampler.start()
+        log.info("Sampling profiler started (every %s s)", self.interval)
+
+    def stop(self):
+        # stop sampling and write out what was collected; returns the file name
+        with self.lock:
+            if not self.running.is_set():
+                return None
+            self.running.clear()
+            sampler = self.sampler
+        sampler.join()
+        return self.dump()
+
+    def toggle(self):
+        if self.running.is_set():
+            filename = self.stop()
+            return 'Profiler stopped, samples written to {}'.format(filename)
+        self.start()
+        return 'Profiler started'
+
+    def _sample_loop(self):
+        me = threading.get_ident()
+        while self.running.is_set():
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                frames = []
+                while frame:
+                    code = frame.f_code
+                    frames.append('{}:{}'.format(os.path.basename(code.co_filename), code.co_name))
+                    frame = frame.f_back
+                frames.reverse()
+                stages = _stages.get(ident)
+                tag = '[{}]'.format('/'.join(stages)) if stages else '[idle]'
+                self.counts[';'.join([names.get(ident, str(ident)), tag] + frames)] += 1
+            time.sleep(self.interval)
+
+    def dump(self):
+        filename = os.path.join(self.output_dir, 'profile_{}.collapsed'.format(time.strftime('%Y%m%d-%H%M%S')))
+        with open(filename, 'w') as f:
+            for stack, count in self.counts.most_common():
+                f.write('{} {}\n'.format(stack, count))
+        log.info("Wrote %d profile samples to %s", sum(self.counts.values()), filename)
+        return filename
+
+    def watch_control_file(self, path, poll_seconds=5):
+        # start profiling when the control file appears and stop when it is removed;
+        # only changes count, so SIGUSR1 and the inbox command still work in between
+        def watch():
+            existed = os.path.exists(path)
+            if existed and not self.running.is_set():
+                log.info(self.toggle())
+            while True:
+                time.sleep(poll_seconds)
+                exists = os.path.exists(path)
+                if exists != existed and exists != self.running.is_set():
+                    log.info(self.toggle())
+                existed = exists
+        threading.Thread(target=watch, name='profiler_control', daemon=True).start()
@@ -0,0 +1,223 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from log_utils import get_logger
+
+log = get_logger('reddit_utils')
+
+class AckBuffer:
+    # Collects handled inbox items and marks them read in bulk,
+    # rather than spending one API write per item
+    def __init__(self, reddit, max_items=25, max_age=30):
+        self.reddit = reddit
+        self.max_items = max_items
+        self.max_age = max_age
+        self.items = []
+        self.oldest = None
+        self.lock = threading.Lock()
+
+    def add(self, item):
+        with self.lock:
+            if not self.items:
+                self.oldest = time.monotonic()
+            self.items.append(item)
+        self.tick()
+
+    def tick(self):
+        # flush if either the size or the time threshold has been reached
+        with self.lock:
+            due = self.items and (len(self.items) >= self.max_items or time.monotonic() - self.oldest >= self.max_age)
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            items, self.items = self.items, []
+            oldest, self.oldest = self.oldest, None
+        if not items:
+            return
+        try:
+            # PRAW splits this into requests of 25 (Reddit's limit per call)
+            self.reddit.inbox.mark_read(items)
+            log.debug("Marked %d inbox item(s) read", len(items))
+        except Exception:
+            log.exception("Bulk mark_read failed, will retry on next flush")
+            with self.lock:
+                self.items = items + self.items
+                self.oldest = oldest
+
+def is_comment(item):
+    return item is not None and item.fullname.startswith('t1_')
+
+class ThingStore:
+    # In-process cache of comments and submissions fetched in bulk with reddit.info(),
+    # so that parent()/submission lookups don't cost one lazy fetch per object
+    def __init__(self, reddit, max_items=10000):
+        self.reddit = reddit
+        self.max_items = max_items
+        self.things = OrderedDict()
+        self.lock = threading.Lock()
+
+    def fetch(self, fullnames):
+        with self.lock:
+            missing = [fullname for fullname in dict.fromkeys(fullnames) if fullname and fullname not in self.things]
+        fetched = []
+        for start in range(0, len(missing), 100):
+            # one request per 100 fullnames
+            fetched.extend(self.reddit.info(fullnames=missing[start:start+100]))
+        with self.lock:
+            for thing in fetched:
+                self.things[thing.fullname] = thing
+            while len(self.things) > self.max_items:
+                self.things.popitem(last=False)
+        if missing:
+            log.debug("Hydrated %d of %d thing(s) in %d request(s)", len(fetched), len(missing), -(-len(missing)//100))
+        return fetched
+
+    def hydrate(self, items, depth=2):
+        # fetch the submissions and the first `depth` levels of parents of a batch of items;
+        # only comments have either (inbox comments carry `context` rather than `link_id`,
+        # and item.submission works out the fullname from whichever is there)
+        comments = [item for item in items if is_comment(item)]
+        self.fetch([item.submission.fullname for item in comments])
+        for level in range(depth):
+            # a chain ends at a submission; reading parent_id from one would fetch its whole comment page
+            parent_ids = [item.parent_id for item in comments]
+            self.fetch([fullname for fullname in parent_ids if fullname.startswith('t1_')])
+            with self.lock:
+                comments = [self.things[fullname] for fullname in parent_ids if fullname.startswith('t1_') and fullname in self.things]
+
+    def get(self, fullname):
+        with self.lock:
+            if fullname in self.things:
+                self.things.move_to_end(fullname)
+                return self.things[fullname]
+        self.fetch([fullname])
+        with self.lock:
+            return self.things.get(fullname)
+
+    def parent(self, item):
+        return self.get(item.parent_id)
+
+    def submission(self, item):
+        return self.get(item.submission.fullname)
+
+class StreamCheckpoint:
+    # Persists the last processed item of each stream to a small JSON file
+    # so that a restart can pick up where the previous run left off
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.attempts = {} # (stream, fullname) -> times handed out without being handled
+        try:
+            with open(filename, 'r') as f:
+                self.streams = json.load(f)
+        except FileNotFoundError:
+            self.streams = {}
+        except ValueError:
+            log.warning("Checkpoint file %s is corrupt, starting fresh", filename)
+            self.streams = {}
+
+    def get(self, stream_name):
+        with self.lock:
+            return self.streams.get(stream_name)
+
+    def update(self, stream_name, item):
+        with self.lock:
+            self.streams[stream_name] = {'fullname': item.fullname, 'created_utc': item.created_utc}
+            self.attempts.pop((stream_name, item.fullname), None)
+            # write to a temp file first so a crash never leaves a half-written checkpoint
+            tmp_filename = self.filename + '.tmp'
+            with open(tmp_filename, 'w') as f:
+                json.dump(self.streams, f)
+            os.replace(tmp_filename, self.filename)
+
+    def attempt(self, stream_name, item, max_attempts):
+        # count a handling attempt; False once the item has failed too often and should be skipped
+        key = (stream_name, item.fullname)
+        with self.lock:
+            self.attempts[key] = self.attempts.get(key, 0) + 1
+            return self.attempts[key] <= max_attempts
+
+    def is_new(self, stream_name, item):
+        last = self.get(stream_name)
+        if not last:
+            return True
+        if item.fullname == last['fullname']:
+            return False
+        return item.created_utc >= last['created_utc']
+
+def catch_up(reddit, path, checkpoint, stream_name, max_pages=10):
+    # Fetch everything newer than the checkpoint, 100 items per request,
+    # paging towards the present with the listing's before= cursor
+    last = checkpoint.get(stream_name)
+    if not last:
+        return []
+    items = []
+    cursor = last['fullname']
+    for page_number in range(max_pages):
+        page = list(reddit.get(path, params={'before': cursor, 'limit': 100}))
+        if not page:
+            break
+        # listings are newest first
+        items.extend(reversed(page))
+        cursor = page[0].fullname
+    else:
+        log.warning("Caught up on %d page(s) of %s without reaching the present, newer items may be missed", max_pages, path)
+    if not items:
+        # before= also comes back empty when the checkpointed item has left the listing
+        # (removed, spam-filtered or pushed out of the ~1000 items Reddit keeps)
+        items = catch_up_from_newest(reddit, path, checkpoint, stream_name, max_pages)
+    if items:
+        log.info("Caught up on %d item(s) from %s", len(items), path)
+    return items
+
+def catch_up_from_newest(reddit, path, checkpoint, stream_name, max_pages=10):
+    # page back from the newest item with after= until reaching the checkpoint's time
+    last = checkpoint.get(stream_name)
+    items = []
+    params = {'limit': 100}
+    for page_number in range(max_pages):
+        page = list(reddit.get(path, params=params))
+        items.extend(item for item in page if checkpoint.is_new(stream_name, item))
+        if not page or page[-1].created_utc <= last['created_utc']:
+            break
+        params['after'] = page[-1].fullname
+    else:
+        log.warning("Read %d page(s) of %s without reaching the checkpoint, older items are skipped", max_pages, path)
+    # oldest first, like the rest of the stream
+    return list(reversed(items))
+
+def checkpointed_stream(reddit, path, stream, checkpoint, stream_name, max_pages=10, hydrate=None, max_attempts=3):
+    # Yields the items missed since the last checkpoint, then the live stream.
+    # Live items are gathered per poll so that `hydrate` can prepare each batch at once.
+    # The checkpoint advances only once the consumer asks for the next item,
+    # i.e. after the previous one has been fully handled. An item whose handling
+    # keeps raising is skipped after max_attempts, so it can't stall the stream.
+    def drain(batch):
+        if hydrate and batch:
+            hydrate(batch)
+        for item in batch:
+            if checkpoint.attempt(stream_name, item, max_attempts):
+                yield item
+            else:
+                log.warning("Skipping %s after %d failed attempts", item.fullname, max_attempts)
+            checkpoint.update(stream_name, item)
+
+    resuming = checkpoint.get(stream_name) is not None
+    yield from drain(catch_up(reddit, path, checkpoint, stream_name, max_pages))
+    batch = []
+    for item in stream(pause_after=0, skip_existing=not resuming):
+        if item is None:
+            # the stream pauses (yields None) once a poll turns up nothing new
+            yield from drain(batch)
+            batch = []
+            yield None
+            continue
+        if checkpoint.is_new(stream_name, item):
+            batch.append(item)
+        if len(batch) >= 100:
+            yield from drain(batch)
+            batch = []
@@ -0,0 +1,45 @@
+import threading
+from log_utils import get_logger
+
+log = get_logger('sample_controller')
+
+class SampleController:
+    # Chooses num_return_sequences per (model, path) from the observed share of samples
+    # that survive cleaning and filtering. Each request costs the prompt plus sample_cost
+    # per sample, and at least one sample passes with probability 1-(1-p)^n; n is picked
+    # to minimize the expected cost per successful post or reply.
+    def __init__(self, min_samples=1, max_samples=4, sample_cost=100, decay=0.98, prior=(1, 1)):
+        self.min_samples = min_samples
+        self.max_samples = max_samples
+        self.sample_cost = sample_cost # in characters of budget
+        self.decay = decay # older observations fade so the estimate tracks drift
+        self.prior = prior # pseudo-counts of (accepted, rejected)
+        self.counts = {} # (model, path) -> [accepted, rejected]
+        self.lock = threading.Lock()
+
+    def acceptance(self, model, path):
+        with self.lock:
+            accepted, rejected = self.counts.get((model, path), (0.0, 0.0))
+        return (accepted + self.prior[0]) / (accepted + rejected + self.prior[0] + self.prior[1])
+
+    def record(self, model, path, accepted):
+        with self.lock:
+            counts = self.counts.setdefault((model, path), [0.0, 0.0])
+            counts[0] *= self.decay
+            counts[1] *= self.decay
+            counts[0 if accepted else 1] += 1
+
+    def expected_cost(self, n, p, prompt_chars):
+        success = 1 - (1 - p)**n
+        return (prompt_chars + n * self.sample_cost) / max(success, 1e-9)
+
+    def samples(self, model, path, prompt_chars):
+        p = self.acceptance(model, path)
+        n = min(range(self.min_samples, self.max_samples + 1), key=lambda n: self.expected_cost(n, p, prompt_chars))
+        log.debug("Requesting %d sample(s) for %s (acceptance %.2f)", n, path, p, extra={'fields': {'model': model, 'path': path, 'acceptance': p, 'samples': n}})
+        return n
+
+    def stats(self):
+        with self.lock:
+            keys = list(self.counts)
+        return {'{}:{}'.format(path, model): round(self.acceptance(model, path), 3) for model, path in keys}
@@ -3,8 +3,7 @@ import logging
 import random
 import re
 
-import ftfy
-import codecs
+from text_utils import decode_generated_text
 
 from praw.models import Comment as praw_Comment
 
@@ -33,6 +32,21 @@ class TaggingMixin():
 
     _end_tag = '<|'
 
+    # optional reddit_utils.ThingStore serving parents/submissions from bulk-fetched objects
+    thing_store = None
+    # optional text_utils.TextPool for running the decoding off the calling thread
+    text_pool = None
+
+    def _get_parent(self, praw_thing):
+        if self.thing_store:
+            return self.thing_store.parent(praw_thing)
+        return praw_thing.parent()
+
+    def _get_submission(self, praw_thing):
+        if self.thing_store:
+            return self.thing_store.submission(praw_thing)
+        return praw_thing.submission
+
     def describe_image(self,url):
         # Settings below for Azure vision
         headers = {
@@ -71,13 +85,15 @@ class TaggingMixin():
         if use_reply_sense:
             if isinstance(praw_thing, praw_Comment):
                 # Need this praw_Comment check for message replies
-                if praw_thing.submission:
+                submission = self._get_submission(praw_thing)
+                if submission:
                     # The submission was by the bot so use special tag
-                    if praw_thing.submission.author.name.lower() == bot_username.lower():
+                    if submission.author.name.lower() == bot_username.lower():
                         return '<|soopr|>'
-                if praw_thing.parent():
+                parent = self._get_parent(praw_thing)
+                if parent:
                     # if the parent's parent was by the author bot, use the own content tag
-                    if praw_thing.parent().author.name.lower() == bot_username.lower():
+                    if parent.author.name.lower() == bot_username.lower():
                         return '<|soocr|>'
 
         # It's just a straight reply
@@ -146,12 +162,12 @@ class TaggingMixin():
     def tag_comment(self, praw_thing, use_reply_sense=False):
         if use_reply_sense:
 
-            if praw_thing.submission.author.name == praw_thing.author:
+            if self._get_submission(praw_thing).author.name == praw_thing.author:
                 return f'<|soopr|>{praw_thing.body}<|eoopr|>'
 
             parent_parent = None
             try:
-                parent_parent = praw_thing.parent().parent()
+                parent_parent = self._get_parent(self._get_parent(praw_thing))
                 if parent_parent.author.name == praw_thing.author:
                     return f'<|soocr|>{praw_thing.body}<|eoocr|>'
             except:
@@ -266,4 +282,6 @@ class TaggingMixin():
         return re.sub(r'(\<\|[\w\/ ]*\|\>)', ' ', input_string).strip()
 
     def _decode_generated_text(self, text):
-        return ftfy.fix_text(codecs.decode(text, "unicode_escape"))
+        if self.text_pool:
+            return self.text_pool.call(decode_generated_text, text)
+        return decode_generated_text(text)
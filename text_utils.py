@@ -0,0 +1,107 @@
+import codecs
+import multiprocessing
+import re
+from concurrent.futures import ProcessPoolExecutor
+import ftfy
+from nltk import word_tokenize
+from rake_nltk import Rake
+
+# Pure text stages, kept free of bot state so they can run in worker processes
+
+def words_below(string,max_words):
+    # check to see if an input string would exceed token budget
+    token_list = word_tokenize(string)
+    if len(token_list)>max_words:
+        return False
+    else:
+        return True
+
+def clean_text(generated_text):
+    # look for double-quotes
+    truncate = generated_text.find('"')
+    if truncate>-1:
+        cleanStr = generated_text[:truncate]
+        return cleanStr
+    # if we can't find double-quotes, look for the last newline
+    truncate = generated_text.rfind('\n')
+    if truncate>-1:
+        cleanStr = generated_text[:truncate]
+        return cleanStr
+    # if we can't find a newline, look for the last terminal punctuation or start of new post
+    if re.search(r'[?.!(Reply|Post)]', generated_text):
+        trimPart = re.split(r'[?.!(Reply|Post)]', generated_text)[-1]
+        cleanStr = generated_text.replace(trimPart,'')
+        return cleanStr
+    # if we can't find a newline, use the last space
+    truncate = generated_text.rfind(' ')
+    if truncate>-1:
+        cleanStr = generated_text[:truncate]
+        # using the last space may result in a trailing comma or colon; remove it
+        if cleanStr[-1] in ',;:':
+            cleanStr = cleanStr[:-1]
+        return cleanStr
+    # if we can't even find any spaces, give up
+    return None
+
+def get_keywords(text):
+    rake_nltk_var = Rake()
+    rake_nltk_var.extract_keywords_from_text(text)
+    keyword_extracted = rake_nltk_var.get_ranked_phrases()[:10]
+    return keyword_extracted
+
+def clean_title(generated_text):
+    # post titles should be a single line
+    truncate = generated_text.rfind('\n')
+    if truncate>-1:
+        generated_text = generated_text[:truncate+1]
+    return clean_text(generated_text)
+
+def decode_generated_text(text):
+    return ftfy.fix_text(codecs.decode(text, "unicode_escape"))
+
+# negative keyword patterns, compiled once per process by init_worker
+_keyword_patterns = []
+
+def find_bad_keywords(text):
+    return [keyword for keyword, pattern in _keyword_patterns if pattern.search(text)]
+
+def init_worker(negative_keywords, warm_up=True):
+    global _keyword_patterns
+    _keyword_patterns = [(keyword, re.compile(r"\b{}\b".format(keyword), re.IGNORECASE)) for keyword in negative_keywords]
+    if warm_up:
+        # load the NLTK tokenizer and stopwords once, rather than on a worker's first real task
+        words_below('warm up', 1)
+        get_keywords('warm up the keyword extractor')
+
+class TextPool:
+    # Runs the pure text stages inline (processes=0) or in a process pool,
+    # so that busy bots can spread preprocessing across cores instead of contending for the GIL.
+    # Only batches are worth the round trip to a worker: single short strings (keyword checks,
+    # keyword extraction, a second clean_text pass) are handled inline by the callers,
+    # so the keyword patterns are compiled in this process too.
+    def __init__(self, negative_keywords, processes=0, batch_size=16):
+        self.processes = processes
+        self.batch_size = batch_size
+        self.executor = None
+        init_worker(negative_keywords, warm_up=False)
+        if processes:
+            # spawn rather than fork, since the pool starts while the bot's threads are running
+            self.executor = ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context('spawn'), initializer=init_worker, initargs=(negative_keywords,))
+
+    def call(self, func, *args):
+        if not self.executor:
+            return func(*args)
+        return self.executor.submit(func, *args).result()
+
+    def map(self, func, items):
+        # items go to the workers in chunks of at most batch_size to amortize IPC,
+        # but small enough that a short list is still spread over every worker
+        if not self.executor:
+            return [func(item) for item in items]
+        items = list(items)
+        chunksize = max(1, min(self.batch_size, -(-len(items) // self.processes)))
+        return list(self.executor.map(func, items, chunksize=chunksize))
+
+    def shutdown(self):
+        if self.executor:
+            self.executor.shutdown(wait=False)
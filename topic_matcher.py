@@ -0,0 +1,111 @@
+import threading
+from collections import OrderedDict
+import numpy as np
+from moderation import hashed_features
+from log_utils import get_logger
+
+log = get_logger('topic_matcher')
+
+def unit_vectors(vectors):
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+class HashedEmbedder:
+    # Dependency-free lexical matching on the same hashed n-grams as the local toxicity model.
+    # A label scores the share of its n-grams present in the text, since cosine similarity
+    # between a one-word label and a whole post shrinks as the post gets longer.
+    def __init__(self, dim=4096):
+        self.dim = dim
+
+    def embed(self, texts):
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for index in hashed_features(text, self.dim):
+                vectors[row, index] = 1
+        return vectors
+
+    def scale(self, vectors, labels):
+        if labels:
+            return vectors / np.maximum(vectors.sum(axis=1, keepdims=True), 1)
+        return vectors
+
+class SentenceTransformerEmbedder:
+    # semantic embeddings from the optional sentence-transformers package, run on CPU
+    def __init__(self, model_name):
+        from sentence_transformers import SentenceTransformer
+        self.model = SentenceTransformer(model_name, device='cpu')
+
+    def embed(self, texts):
+        return np.asarray(self.model.encode(list(texts), batch_size=32), dtype=np.float32)
+
+    def scale(self, vectors, labels):
+        # cosine similarity
+        return unit_vectors(vectors)
+
+def load_embedder(spec):
+    # "hashed" (or empty) for HashedEmbedder, otherwise a sentence-transformers model name
+    if not spec or spec == 'hashed':
+        return HashedEmbedder()
+    return SentenceTransformerEmbedder(spec)
+
+class TopicMatcher:
+    # Local alternative to zero-shot topic classification: the topic list is embedded once,
+    # incoming texts are embedded in batches and cached, and every label is scored
+    # with a single matrix product (cosine similarity, or label coverage for HashedEmbedder)
+    def __init__(self, embedder, threshold, cache_size=4096):
+        self.embedder = embedder
+        self.threshold = threshold
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.topic_list = []
+        self.topic_vectors = None
+
+    def vectors(self, texts, labels=False):
+        # scaled vectors for texts (or topic labels), embedding only the ones not already cached (in one batch)
+        with self.lock:
+            missing = [text for text in dict.fromkeys(texts) if (labels, text) not in self.cache]
+        if missing:
+            embedded = self.embedder.scale(self.embedder.embed(missing), labels)
+            with self.lock:
+                for text, vector in zip(missing, embedded):
+                    self.cache[labels, text] = vector
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        with self.lock:
+            found = {text: self.cache.get((labels, text)) for text in texts}
+        # an entry can be evicted by another thread in between; embed it again if so
+        return np.stack([found[text] if found[text] is not None else self.vectors([text], labels)[0] for text in texts])
+
+    def set_topics(self, topic_list):
+        # embed first, then swap both at once so a reader never pairs new labels with old vectors
+        topic_list = list(topic_list)
+        topic_vectors = self.vectors(topic_list, labels=True) if topic_list else None
+        with self.lock:
+            self.topic_list, self.topic_vectors = topic_list, topic_vectors
+        log.info("Embedded %d topic label(s)", len(topic_list))
+
+    def prefetch(self, texts):
+        texts = [text for text in texts if text]
+        if texts:
+            self.vectors(texts)
+
+    def best_topic(self, text, topic_list=None):
+        # returns (topic, score) for the highest-scoring label
+        with self.lock:
+            current_list, current_vectors = self.topic_list, self.topic_vectors
+        if topic_list is None or list(topic_list) == current_list:
+            topic_list, topic_vectors = current_list, current_vectors
+        else:
+            topic_vectors = self.vectors(topic_list, labels=True)
+        if topic_vectors is None or not len(topic_list):
+            return None, 0.0
+        scores = topic_vectors @ self.vectors([text])[0]
+        best = int(np.argmax(scores))
+        return topic_list[best], float(scores[best])
+
+    def on_topic(self, text, topic_list=None):
+        topic, score = self.best_topic(text, topic_list)
+        if score > self.threshold:
+            log.info('"%s": %s', topic, round(score, 2))
+            return True
+        return False
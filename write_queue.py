@@ -0,0 +1,162 @@
+import json
+import os
+import re
+import threading
+import time
+from praw.exceptions import RedditAPIException
+from prawcore.exceptions import ResponseException
+from log_utils import get_logger
+
+log = get_logger('write_queue')
+
+_wait_pattern = re.compile(r'(\d+)\s*(millisecond|second|minute|hour)', re.IGNORECASE)
+_wait_units = {'millisecond': 0.001, 'second': 1, 'minute': 60, 'hour': 3600}
+
+def ratelimit_delay(error):
+    # seconds to wait according to a RATELIMIT error ("...try again in 9 minutes."), or None
+    for item in error.items:
+        if item.error_type == 'RATELIMIT':
+            match = _wait_pattern.search(item.message)
+            if match:
+                return int(match.group(1)) * _wait_units[match.group(2).lower()]
+            return 60
+    return None
+
+def is_permanent(error):
+    # 4xx responses other than 429 (Forbidden, NotFound, ...) fail the same way on every retry
+    return isinstance(error, ResponseException) and 400 <= error.response.status_code < 500 and error.response.status_code != 429
+
+class WriteQueue:
+    # Durable FIFO of vetted replies and submissions, written to Reddit by a single
+    # background thread at the rate Reddit allows, so watcher threads never block on
+    # writes and generations that have already been paid for are not lost to a RATELIMIT.
+    # An entry that fails for another reason goes to the back with its own retry time,
+    # so it doesn't hold up the writes queued behind it.
+    def __init__(self, reddit, filename, on_written=None, min_interval=0, max_attempts=5):
+        self.reddit = reddit
+        self.filename = filename
+        self.on_written = on_written
+        self.min_interval = min_interval
+        self.max_attempts = max_attempts
+        self.resume_at = 0
+        self.cond = threading.Condition()
+        try:
+            with open(filename, 'r') as f:
+                self.entries = json.load(f)
+            if self.entries:
+                log.info("Loaded %d queued write(s) from %s", len(self.entries), filename)
+        except FileNotFoundError:
+            self.entries = []
+        except ValueError:
+            # keep the unreadable file for inspection rather than overwriting it on the next save
+            log.warning("Write queue file %s is corrupt, moving it to %s.corrupt and starting empty", filename, filename)
+            os.replace(filename, filename + '.corrupt')
+            self.entries = []
+        self.thread = threading.Thread(target=self.run, name='write_queue', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def reply(self, thing, body):
+        return self.enqueue({'kind': 'reply', 'target': thing.fullname, 'subreddit': str(thing.subreddit), 'params': {'body': body}})
+
+    def submit(self, subreddit, **params):
+        return self.enqueue({'kind': 'submit', 'target': subreddit.display_name, 'subreddit': subreddit.display_name, 'params': params})
+
+    def enqueue(self, entry):
+        entry['queued'] = time.time()
+        entry['attempts'] = 0
+        with self.cond:
+            self.entries.append(entry)
+            self.save()
+            self.cond.notify()
+        log.info("Queued %s to %s (%d waiting)", entry['kind'], entry['target'], len(self.entries))
+        return entry
+
+    def is_queued(self, fullname):
+        with self.cond:
+            return any(entry['target'] == fullname for entry in self.entries)
+
+    def save(self):
+        # caller holds self.cond; write to a temp file so a crash never truncates the queue
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_filename, self.filename)
+
+    def write(self, entry):
+        if entry['kind'] == 'submit':
+            return self.reddit.subreddit(entry['target']).submit(**entry['params'])
+        prefix, thing_id = entry['target'].split('_', 1)
+        if prefix == 't3':
+            thing = self.reddit.submission(id=thing_id)
+        else:
+            thing = self.reddit.comment(id=thing_id)
+        return thing.reply(**entry['params'])
+
+    def due(self):
+        # caller holds self.cond; returns (entry, 0) for the first entry that may be written now,
+        # otherwise (None, seconds until one may be), with None seconds for an empty queue
+        if not self.entries:
+            return None, None
+        now = time.time()
+        if now < self.resume_at:
+            return None, self.resume_at - now
+        for entry in self.entries:
+            if entry.get('not_before', 0) <= now:
+                return entry, 0
+        return None, min(entry.get('not_before', 0) for entry in self.entries) - now
+
+    def run(self):
+        while True:
+            with self.cond:
+                entry, wait = self.due()
+                while entry is None:
+                    self.cond.wait(wait)
+                    entry, wait = self.due()
+            result = None
+            written = False
+            drop = False
+            retry = False
+            try:
+                result = self.write(entry)
+                # PRAW returns None when Reddit makes the comment but sends nothing back
+                # (e.g. in quarantined subreddits), so returning at all means it was written
+                written = True
+            except RedditAPIException as error:
+                delay = ratelimit_delay(error)
+                if delay:
+                    log.warning("Rate limited, holding %d queued write(s) for %d seconds", len(self.entries), delay)
+                    self.resume_at = time.time() + delay
+                    continue
+                # any other API error (deleted comment, locked thread, ...) won't go away on retry
+                log.warning("Dropping %s to %s: %s", entry['kind'], entry['target'], error)
+                drop = True
+            except Exception as error:
+                if is_permanent(error):
+                    log.warning("Dropping %s to %s: %s", entry['kind'], entry['target'], error)
+                    drop = True
+                else:
+                    entry['attempts'] += 1
+                    drop = entry['attempts'] >= self.max_attempts
+                    retry = not drop
+                    log.exception("Writing %s to %s failed (attempt %d)", entry['kind'], entry['target'], entry['attempts'])
+                    entry['not_before'] = time.time() + 30 * 2**entry['attempts']
+            with self.cond:
+                if written or drop or retry:
+                    self.entries.remove(entry)
+                if retry:
+                    self.entries.append(entry)
+                self.save()
+            if written:
+                log.info("Wrote %s to %s", entry['kind'], entry['target'])
+                if self.on_written:
+                    self.on_written(entry, result)
+                self.resume_at = max(time.time() + self.min_interval, self.next_window())
+
+    def next_window(self):
+        # if PRAW reports the request budget as spent, wait for it to reset
+        limits = self.reddit.auth.limits
+        if limits.get('remaining') is not None and limits['remaining'] < 1 and limits.get('reset_timestamp'):
+            return limits['reset_timestamp']
+        return 0